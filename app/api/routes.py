@@ -1,5 +1,5 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks, Depends, Header
+from fastapi.responses import JSONResponse, FileResponse
 from typing import List, Optional
 import os
 import uuid
@@ -7,9 +7,10 @@ import shutil
 from datetime import datetime
 import json
 
-from app.services.sam2_service import SAM2Service
+from app.services.sam2_service import SAM2Service, CONTOUR_LOD_TOLERANCES, DEFAULT_CONTOUR_LEVEL
 from app.services.image_service import ImageService
 from app.services.analysis_service import AnalysisService
+from app.services.profiling_service import ProfilingService, RequestProfiler
 from app.models.analysis import AnalysisCreate, AnalysisResponse, SegmentationRequest, ClassificationRequest
 from app.models.upload import UploadResponse
 
@@ -19,6 +20,82 @@ router = APIRouter()
 sam2_service = SAM2Service()
 image_service = ImageService()
 analysis_service = AnalysisService()
+profiling_service = ProfilingService()
+
+def _check_profiling_access(token: Optional[str]):
+    """
+    Reject profiling requests without a valid X-Profiling-Token
+    """
+    if not profiling_service.check_token(token):
+        raise HTTPException(status_code=403, detail="Profiling is not enabled for this request")
+
+async def _request_profiler(
+    profile: bool = False,
+    x_profiling_token: Optional[str] = Header(None)
+):
+    """
+    Hold a profiling session for the request when profile=true, released once it finishes
+    """
+    if not profile:
+        yield None
+        return
+    
+    _check_profiling_access(x_profiling_token)
+    profiler = profiling_service.acquire_profiler()
+    if profiler is None:
+        raise HTTPException(status_code=409, detail="Another profiling session is already running")
+    
+    try:
+        yield profiler
+    finally:
+        profiling_service.release_profiler(profiler)
+
+def _atlas_path(analysis_id: str) -> str:
+    """
+    Get the path of the chromosome atlas saved for an analysis
+    """
+    return os.path.join("results", f"{analysis_id}_atlas.npy")
+
+def _check_contour_level(level: int):
+    """
+    Reject contour levels outside CONTOUR_LOD_TOLERANCES
+    """
+    if not 0 <= level < len(CONTOUR_LOD_TOLERANCES):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Contour level must be between 0 and {len(CONTOUR_LOD_TOLERANCES) - 1}"
+        )
+
+def _flatten_contour(contour: list) -> List[int]:
+    """
+    Convert an OpenCV-style nested [[[x, y]], ...] contour to flat [x0, y0, x1, y1, ...]
+    """
+    return [
+        int(value)
+        for point in contour
+        for value in (point[0] if isinstance(point[0], list) else point)
+    ]
+
+def _select_contour_level(segmentation_results: dict, level: int) -> dict:
+    """
+    Return a copy of the segmentation results carrying only one contour level per chromosome
+
+    The selected level is returned as a flat "contour" with "contour_format": "flat".
+    Results saved before contour levels existed only have the nested full-detail
+    contour, which is flattened and returned for every level.
+    """
+    chromosomes = []
+    for chromosome in segmentation_results.get("chromosomes", []):
+        chromosome = dict(chromosome)
+        contour_lod = chromosome.pop("contour_lod", None)
+        if contour_lod:
+            chromosome["contour"] = contour_lod[level]
+        elif chromosome.get("contour") and chromosome.get("contour_format") != "flat":
+            chromosome["contour"] = _flatten_contour(chromosome["contour"])
+        chromosome["contour_format"] = "flat"
+        chromosomes.append(chromosome)
+    
+    return {**segmentation_results, "chromosomes": chromosomes, "contour_level": level}
 
 @router.post("/upload", response_model=UploadResponse)
 async def upload_image(
@@ -69,10 +146,20 @@ async def upload_image(
     )
 
 @router.post("/segment")
-async def segment_image(request: SegmentationRequest):
+async def segment_image(
+    request: SegmentationRequest,
+    contour_level: int = DEFAULT_CONTOUR_LEVEL,
+    profiler: Optional[RequestProfiler] = Depends(_request_profiler)
+):
     """
     Perform chromosome segmentation using SAM2
+
+    Contours are stored at every level of detail; each chromosome in the response
+    carries only the requested contour_level (coarsest by default) as a flat "contour".
+    Pass profile=true with a valid X-Profiling-Token header to profile the request.
     """
+    _check_contour_level(contour_level)
+    
     try:
         # Get analysis record
         analysis = await analysis_service.get_analysis(request.analysis_id)
@@ -86,7 +173,9 @@ async def segment_image(request: SegmentationRequest):
         segmentation_results = await sam2_service.segment_chromosomes(
             analysis.file_path,
             confidence_threshold=request.confidence_threshold,
-            use_gpu=request.use_gpu
+            use_gpu=request.use_gpu,
+            atlas_path=_atlas_path(request.analysis_id),
+            profiler=profiler
         )
         
         # Save segmentation results
@@ -95,7 +184,9 @@ async def segment_image(request: SegmentationRequest):
         # Update status
         await analysis_service.update_analysis_status(request.analysis_id, "segmented")
         
-        return {
+        segmentation_results = _select_contour_level(segmentation_results, contour_level)
+        
+        response = {
             "analysis_id": request.analysis_id,
             "status": "segmented",
             "chromosome_count": len(segmentation_results["chromosomes"]),
@@ -103,6 +194,11 @@ async def segment_image(request: SegmentationRequest):
             "processing_time": segmentation_results.get("processing_time", 0)
         }
         
+        if profiler:
+            response["profile"] = profiler.report()
+        
+        return response
+        
     except Exception as e:
         await analysis_service.update_analysis_status(request.analysis_id, "error")
         raise HTTPException(status_code=500, detail=f"Segmentation failed: {str(e)}")
@@ -153,10 +249,12 @@ async def classify_chromosomes(request: ClassificationRequest):
         raise HTTPException(status_code=500, detail=f"Classification failed: {str(e)}")
 
 @router.get("/results/{analysis_id}", response_model=AnalysisResponse)
-async def get_analysis_results(analysis_id: str):
+async def get_analysis_results(analysis_id: str, contour_level: int = DEFAULT_CONTOUR_LEVEL):
     """
     Get complete analysis results
     """
+    _check_contour_level(contour_level)
+    
     try:
         analysis = await analysis_service.get_analysis(analysis_id)
         if not analysis:
@@ -165,6 +263,10 @@ async def get_analysis_results(analysis_id: str):
         # Get all results
         results = await analysis_service.get_complete_results(analysis_id)
         
+        segmentation_results = results.get("segmentation_results")
+        if segmentation_results:
+            segmentation_results = _select_contour_level(segmentation_results, contour_level)
+        
         return AnalysisResponse(
             analysis_id=analysis_id,
             filename=analysis.filename,
@@ -172,13 +274,66 @@ async def get_analysis_results(analysis_id: str):
             created_at=analysis.created_at,
             updated_at=analysis.updated_at,
             metadata=analysis.metadata,
-            segmentation_results=results.get("segmentation_results"),
+            segmentation_results=segmentation_results,
             classification_results=results.get("classification_results")
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get results: {str(e)}")
 
+@router.get("/contours/{analysis_id}")
+async def get_chromosome_contours(analysis_id: str, level: int = DEFAULT_CONTOUR_LEVEL):
+    """
+    Get chromosome contours at one level of detail for overlay rendering
+    """
+    _check_contour_level(level)
+    
+    segmentation_results = await analysis_service.get_segmentation_results(analysis_id)
+    if not segmentation_results:
+        raise HTTPException(status_code=404, detail="Segmentation results not found")
+    
+    selected = _select_contour_level(segmentation_results, level)
+    
+    return {
+        "analysis_id": analysis_id,
+        "level": level,
+        "tolerance": CONTOUR_LOD_TOLERANCES[level],
+        "contours": {
+            chromosome["id"]: chromosome["contour"]
+            for chromosome in selected["chromosomes"]
+        }
+    }
+
+@router.get("/atlas/{analysis_id}")
+async def get_chromosome_atlas(analysis_id: str):
+    """
+    Get the tiled sheet of straightened chromosome crops for the karyogram view
+    """
+    segmentation_results = await analysis_service.get_segmentation_results(analysis_id)
+    atlas = (segmentation_results or {}).get("atlas")
+    if not atlas or not os.path.exists(atlas["sheet_path"]):
+        raise HTTPException(status_code=404, detail="Chromosome atlas not found")
+    
+    return FileResponse(atlas["sheet_path"], media_type="image/png")
+
+@router.get("/profiles/{profile_id}/{artifact}")
+async def get_profile_artifact(
+    profile_id: str,
+    artifact: str,
+    x_profiling_token: Optional[str] = Header(None)
+):
+    """
+    Download a stored profiling artifact
+    """
+    _check_profiling_access(x_profiling_token)
+    
+    path = profiling_service.get_artifact_path(profile_id, artifact)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profiling artifact not found")
+    
+    media_type = "text/plain" if artifact.endswith(".txt") else "application/json"
+    return FileResponse(path, media_type=media_type, filename=f"{profile_id}_{artifact}")
+
 @router.get("/history")
 async def get_analysis_history(
     limit: int = 10,
@@ -215,6 +370,8 @@ async def delete_analysis(analysis_id: str):
         if not success:
             raise HTTPException(status_code=404, detail="Analysis not found")
         
+        sam2_service.delete_chromosome_atlas(_atlas_path(analysis_id))
+        
         return {"message": "Analysis deleted successfully"}
         
     except Exception as e:
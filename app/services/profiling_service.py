@@ -0,0 +1,311 @@
+import torch
+import os
+import sys
+import json
+import hmac
+import uuid
+import time
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, List, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+# Seconds between Python stack samples
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Number of hotspots / operators reported in the response
+PROFILE_TOP_N = 15
+
+# One profiling session at a time: the torch profiler cannot run two sessions at once
+_session_lock = threading.Lock()
+
+
+class RequestProfiler:
+    """
+    Profiles a single request: a Python sampling profile of the threads doing
+    the request's work, plus a torch operator profile.
+
+    Work is only profiled while it runs inside section() or a function wrapped
+    with wrap(), which lets the profile follow the request into the thread pool.
+    torch.profiler only records operators on the thread that started it, so each
+    outermost section runs its own torch profiler and the results are merged.
+    """
+
+    def __init__(self, profile_id: str, output_dir: str):
+        self.profile_id = profile_id
+        self.output_dir = output_dir
+        self.samples = Counter()
+        self.sample_count = 0
+        self.wall_time = 0.0
+        self.torch_operators = []
+        self._thread_ids = Counter()
+        self._threads_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._start_time = None
+        # Operator totals and chrome trace events merged across sections
+        self._torch_stats = {}
+        self._trace_events = []
+        self._torch_sections = 0
+        self._torch_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the sampler thread
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._start_time = time.time()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{self.profile_id}", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stop profiling and write the artifacts to the output directory
+        """
+        self.wall_time = time.time() - self._start_time
+        self._stop_event.set()
+        self._sampler.join()
+
+        self._save_python_stacks()
+        with open(os.path.join(self.output_dir, "torch_trace.json"), "w") as f:
+            json.dump({"traceEvents": self._trace_events}, f)
+        self.torch_operators = self._summarize_torch_operators()
+
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    @contextmanager
+    def section(self):
+        """
+        Profile the current thread while inside this block
+        """
+        thread_id = threading.get_ident()
+        with self._threads_lock:
+            self._thread_ids[thread_id] += 1
+            outermost = self._thread_ids[thread_id] == 1
+
+        torch_profiler = self._start_torch_profiler() if outermost else None
+        try:
+            yield
+        finally:
+            if torch_profiler is not None:
+                self._collect_torch_profiler(torch_profiler)
+            with self._threads_lock:
+                self._thread_ids[thread_id] -= 1
+                if self._thread_ids[thread_id] <= 0:
+                    del self._thread_ids[thread_id]
+
+    def _start_torch_profiler(self):
+        """
+        Start a torch operator profiler on the current thread
+        """
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        try:
+            torch_profiler = torch.profiler.profile(activities=activities)
+            torch_profiler.start()
+            return torch_profiler
+        except Exception as e:
+            logger.warning(f"Failed to start torch profiler: {str(e)}")
+            return None
+
+    def _collect_torch_profiler(self, torch_profiler):
+        """
+        Stop a section's torch profiler and merge its operators and trace events
+        """
+        try:
+            torch_profiler.stop()
+            with self._torch_lock:
+                self._torch_sections += 1
+                trace_path = os.path.join(self.output_dir, f".torch_trace_{self._torch_sections}.json")
+
+            torch_profiler.export_chrome_trace(trace_path)
+            with open(trace_path) as f:
+                trace_events = json.load(f).get("traceEvents", [])
+            os.remove(trace_path)
+
+            with self._torch_lock:
+                self._trace_events.extend(trace_events)
+                for event in torch_profiler.key_averages():
+                    # Newer torch versions renamed the CUDA counters to "device"
+                    self_cuda_time = getattr(event, "self_device_time_total", None)
+                    if self_cuda_time is None:
+                        self_cuda_time = getattr(event, "self_cuda_time_total", 0)
+                    stats = self._torch_stats.setdefault(event.key, [0, 0.0, 0.0, 0.0])
+                    stats[0] += event.count
+                    stats[1] += event.self_cpu_time_total
+                    stats[2] += event.cpu_time_total
+                    stats[3] += self_cuda_time
+        except Exception as e:
+            logger.warning(f"Failed to collect torch profile: {str(e)}")
+
+    def wrap(self, func: Callable) -> Callable:
+        """
+        Wrap func so it is profiled in whichever thread runs it
+        """
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            with self.section():
+                return func(*args, **kwargs)
+        return profiled
+
+    def _sample_loop(self):
+        """
+        Record the stacks of the registered threads every PROFILE_SAMPLE_INTERVAL
+        """
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(PROFILE_SAMPLE_INTERVAL):
+            with self._threads_lock:
+                thread_ids = list(self._thread_ids)
+            if not thread_ids:
+                continue
+
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                self.samples[tuple(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def _save_python_stacks(self):
+        """
+        Write the samples in folded-stack format (flamegraph.pl / speedscope)
+        """
+        with open(os.path.join(self.output_dir, "python_stacks.txt"), "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def _python_hotspots(self) -> List[Dict[str, Any]]:
+        """
+        Rank functions by the samples in which they were on top of the stack
+        """
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in self.samples.items():
+            self_samples[stack[-1]] += count
+            for function in set(stack):
+                total_samples[function] += count
+
+        total = max(self.sample_count, 1)
+        return [
+            {
+                "function": function,
+                "self_samples": count,
+                "total_samples": total_samples[function],
+                "self_percent": round(100.0 * count / total, 2),
+                "total_percent": round(100.0 * total_samples[function] / total, 2)
+            }
+            for function, count in self_samples.most_common(PROFILE_TOP_N)
+        ]
+
+    def _summarize_torch_operators(self) -> List[Dict[str, Any]]:
+        """
+        Rank torch operators by self CPU time
+        """
+        ranked = sorted(self._torch_stats.items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                "name": name,
+                "calls": int(calls),
+                "self_cpu_ms": self_cpu / 1000.0,
+                "cpu_total_ms": cpu_total / 1000.0,
+                "self_cuda_ms": self_cuda / 1000.0
+            }
+            for name, (calls, self_cpu, cpu_total, self_cuda) in ranked[:PROFILE_TOP_N]
+        ]
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Hotspot breakdown and artifact links to return with the response
+        """
+        return {
+            "profile_id": self.profile_id,
+            "wall_time": self.wall_time,
+            "python": {
+                "sample_count": self.sample_count,
+                "sample_interval": PROFILE_SAMPLE_INTERVAL,
+                "hotspots": self._python_hotspots()
+            },
+            "torch": {
+                # CPU operators are recorded only on this request's threads while they
+                # run its work; CUDA kernels are recorded device-wide and may include
+                # other requests running at the same time.
+                "scope": {"cpu": "request", "cuda": "process"},
+                "sections": self._torch_sections,
+                "operators": self.torch_operators
+            },
+            "artifacts": {
+                name: f"/api/profiles/{self.profile_id}/{name}"
+                for name in ProfilingService.ARTIFACTS
+            }
+        }
+
+
+class ProfilingService:
+    """
+    Service class for opt-in, token-protected request profiling
+
+    Profiling is disabled unless CHROMOSCOPE_PROFILING_TOKEN is set; requests
+    must send the same value in the X-Profiling-Token header.
+    """
+
+    ARTIFACTS = ("python_stacks.txt", "torch_trace.json", "summary.json")
+
+    def __init__(self):
+        self.token = os.environ.get("CHROMOSCOPE_PROFILING_TOKEN")
+        self.output_path = "results/profiles"
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self.token)
+
+    def check_token(self, token: Optional[str]) -> bool:
+        """
+        Check a client-supplied token against the configured one
+        """
+        if not self.is_enabled or not token:
+            return False
+        return hmac.compare_digest(token.encode(), self.token.encode())
+
+    def acquire_profiler(self) -> Optional[RequestProfiler]:
+        """
+        Take the profiling session and create a profiler writing to its own
+        artifact directory; returns None if another session is running.
+        Pair with release_profiler().
+        """
+        if not _session_lock.acquire(blocking=False):
+            return None
+        profile_id = str(uuid.uuid4())
+        return RequestProfiler(profile_id, os.path.join(self.output_path, profile_id))
+
+    def release_profiler(self, profiler: RequestProfiler):
+        """
+        Release the profiling session taken by acquire_profiler()
+        """
+        _session_lock.release()
+
+    def get_artifact_path(self, profile_id: str, artifact: str) -> Optional[str]:
+        """
+        Get the path of a stored profiling artifact, if it exists
+        """
+        if artifact not in self.ARTIFACTS:
+            return None
+        try:
+            uuid.UUID(profile_id)
+        except ValueError:
+            return None
+
+        path = os.path.join(self.output_path, profile_id, artifact)
+        return path if os.path.exists(path) else None
@@ -8,8 +8,11 @@ from datetime import datetime
 import logging
 from pathlib import Path
 import asyncio
+from contextlib import nullcontext
 from concurrent.futures import ThreadPoolExecutor
 
+from app.services.profiling_service import RequestProfiler
+
 # SAM2 imports (will be installed via requirements.txt)
 try:
     from sam2.build_sam import build_sam2
@@ -22,6 +25,17 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Size of each straightened chromosome crop in the atlas (long axis vertical)
+ATLAS_CROP_HEIGHT = 128
+ATLAS_CROP_WIDTH = 64
+# Fraction of the crop left as padding around the chromosome
+ATLAS_CROP_MARGIN = 0.1
+
+# Simplification tolerance (pixels) for each contour level of detail; level 0 is the full contour
+CONTOUR_LOD_TOLERANCES = (0.0, 1.0, 2.5, 5.0)
+# Level returned when the client does not ask for one
+DEFAULT_CONTOUR_LEVEL = len(CONTOUR_LOD_TOLERANCES) - 1
+
 class SAM2Service:
     """
     Service class for SAM2 chromosome segmentation
@@ -156,38 +170,72 @@ class SAM2Service:
         self, 
         image_path: str, 
         confidence_threshold: float = 0.8,
-        use_gpu: bool = True
+        use_gpu: bool = True,
+        atlas_path: Optional[str] = None,
+        profiler: Optional[RequestProfiler] = None
     ) -> Dict[str, Any]:
         """
         Segment chromosomes from metaphase spread image
+
+        If atlas_path is given, straightened crops of the accepted chromosomes
+        are packed into an atlas saved at that path (see _build_chromosome_atlas).
+        If profiler is given, the request is profiled from start to finish.
         """
         if not self.is_initialized:
             raise RuntimeError("SAM2 service not initialized")
         
+        section = profiler.section if profiler else nullcontext
+        if profiler:
+            profiler.start()
+        
         try:
             start_time = time.time()
             
             # Load and preprocess image
-            image = cv2.imread(image_path)
-            if image is None:
-                raise ValueError(f"Could not load image: {image_path}")
-            
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            with section():
+                image = cv2.imread(image_path)
+                if image is None:
+                    raise ValueError(f"Could not load image: {image_path}")
+                
+                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             
             # Run segmentation in thread pool
             loop = asyncio.get_event_loop()
             masks = await loop.run_in_executor(
                 self.executor, 
-                self._segment_image, 
+                self._profiled(profiler, self._segment_image), 
                 image_rgb, 
                 confidence_threshold
             )
             
-            # Process masks and extract chromosome information
-            chromosomes = self._process_masks(masks, image_rgb)
-            
-            # Filter chromosomes based on size and shape
-            filtered_chromosomes = self._filter_chromosomes(chromosomes)
+            with section():
+                # Process masks and extract chromosome information
+                chromosomes = self._process_masks(masks, image_rgb)
+                
+                # Filter chromosomes based on size and shape
+                filtered_chromosomes = self._filter_chromosomes(chromosomes)
+            
+            # Pack straightened crops of the accepted chromosomes into an atlas.
+            # The atlas is optional, so a failure here does not fail segmentation.
+            atlas = None
+            if atlas_path and filtered_chromosomes:
+                # Chromosome ids are "chr_<mask index>", see _process_masks
+                accepted_masks = [
+                    masks[int(chromosome["id"].split("_", 1)[1])]["segmentation"]
+                    for chromosome in filtered_chromosomes
+                ]
+                try:
+                    atlas = await loop.run_in_executor(
+                        self.executor,
+                        self._profiled(profiler, self._build_chromosome_atlas),
+                        image_rgb,
+                        accepted_masks,
+                        [chromosome["id"] for chromosome in filtered_chromosomes],
+                        atlas_path
+                    )
+                except Exception as e:
+                    logger.warning(f"Failed to build chromosome atlas: {str(e)}")
+                    self.delete_chromosome_atlas(atlas_path)
             
             processing_time = time.time() - start_time
             
@@ -200,12 +248,23 @@ class SAM2Service:
                     "height": image_rgb.shape[0]
                 },
                 "confidence_threshold": confidence_threshold,
+                "atlas": atlas,
                 "timestamp": datetime.now().isoformat()
             }
             
         except Exception as e:
             logger.error(f"Segmentation failed: {str(e)}")
             raise
+        
+        finally:
+            if profiler:
+                profiler.stop()
+    
+    def _profiled(self, profiler: Optional[RequestProfiler], func):
+        """
+        Wrap func for profiling when a profiler is active, otherwise return it unchanged
+        """
+        return profiler.wrap(func) if profiler else func
     
     def _segment_image(self, image_rgb: np.ndarray, confidence_threshold: float) -> List[Dict]:
         """
@@ -261,6 +320,7 @@ class SAM2Service:
             
             # Get the largest contour
             main_contour = max(contours, key=cv2.contourArea)
+            contour_lod = self._simplify_contour(main_contour)
             
             # Calculate basic properties
             area = cv2.contourArea(main_contour)
@@ -291,7 +351,7 @@ class SAM2Service:
             return {
                 "id": f"chr_{index}",
                 "mask": mask.tolist(),
-                "contour": main_contour.tolist(),
+                "contour_lod": contour_lod,
                 "bbox": {"x": int(x), "y": int(y), "width": int(w), "height": int(h)},
                 "centroid": {"x": int(cx), "y": int(cy)},
                 "area": int(area),
@@ -310,6 +370,16 @@ class SAM2Service:
             logger.warning(f"Failed to extract features for chromosome {index}: {str(e)}")
             return None
     
+    def _simplify_contour(self, contour: np.ndarray) -> List[List[int]]:
+        """
+        Build flat [x0, y0, x1, y1, ...] contours, one per CONTOUR_LOD_TOLERANCES level
+        """
+        levels = []
+        for tolerance in CONTOUR_LOD_TOLERANCES:
+            simplified = cv2.approxPolyDP(contour, tolerance, True) if tolerance > 0 else contour
+            levels.append(simplified.reshape(-1).astype(int).tolist())
+        return levels
+    
     def _filter_chromosomes(self, chromosomes: List[Dict]) -> List[Dict]:
         """
         Filter chromosomes based on size and shape criteria
@@ -336,11 +406,158 @@ class SAM2Service:
         
         return filtered
     
+    def _build_chromosome_atlas(
+        self,
+        image_rgb: np.ndarray,
+        masks: List[np.ndarray],
+        chromosome_ids: List[str],
+        atlas_path: str
+    ) -> Dict[str, Any]:
+        """
+        Cut out every chromosome in one batched pass and pack the crops into an atlas
+
+        Each crop is rotated so the chromosome's major axis is vertical and scaled
+        to fit ATLAS_CROP_HEIGHT x ATLAS_CROP_WIDTH (same scale on both axes, so
+        the relative size is kept in the index). Background pixels are zeroed.
+        The crops are saved as one contiguous (N, H, W, 3) uint8 array plus a
+        tiled PNG sheet for the karyogram view.
+        """
+        height, width = image_rgb.shape[:2]
+        count = len(masks)
+        crop_h, crop_w = ATLAS_CROP_HEIGHT, ATLAS_CROP_WIDTH
+        
+        # Per-chromosome centroid and normalized central moments, each from its own
+        # mask so overlapping or crossing chromosomes do not cut into each other
+        masks = [mask.astype(bool) for mask in masks]
+        cx, cy = np.zeros(count), np.zeros(count)
+        mu20, mu02, mu11 = np.zeros(count), np.zeros(count), np.zeros(count)
+        for slot, mask in enumerate(masks):
+            M = cv2.moments(mask.astype(np.uint8), binaryImage=True)
+            if M["m00"] == 0:
+                continue
+            cx[slot] = M["m10"] / M["m00"]
+            cy[slot] = M["m01"] / M["m00"]
+            mu20[slot] = M["mu20"] / M["m00"]
+            mu02[slot] = M["mu02"] / M["m00"]
+            mu11[slot] = M["mu11"] / M["m00"]
+        
+        # Major axis orientation and extent (a filled bar of length L has variance L^2 / 12)
+        angle = 0.5 * np.arctan2(2 * mu11, mu20 - mu02)
+        half_spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+        length = np.sqrt(12 * np.maximum((mu20 + mu02) / 2 + half_spread, 0))
+        thickness = np.sqrt(12 * np.maximum((mu20 + mu02) / 2 - half_spread, 0))
+        
+        # Input pixels per output pixel, so the chromosome fits inside the margin
+        usable = 1 - 2 * ATLAS_CROP_MARGIN
+        scale = np.maximum(length / (crop_h * usable), thickness / (crop_w * usable))
+        scale = np.where(scale > 0, scale, 1.0)
+        
+        # Affine map from normalized crop coordinates to normalized image coordinates:
+        # the crop's vertical axis follows the major axis (cos, sin), the horizontal
+        # axis follows (sin, -cos).
+        cos, sin = np.cos(angle), np.sin(angle)
+        theta = np.zeros((count, 2, 3), dtype=np.float32)
+        theta[:, 0, 0] = scale * sin * crop_w / width
+        theta[:, 0, 1] = scale * cos * crop_h / width
+        theta[:, 0, 2] = (2 * cx + 1) / width - 1
+        theta[:, 1, 0] = -scale * cos * crop_w / height
+        theta[:, 1, 1] = scale * sin * crop_h / height
+        theta[:, 1, 2] = (2 * cy + 1) / height - 1
+        
+        device = self.device if self.device is not None else torch.device("cpu")
+        with torch.no_grad():
+            grid = torch.nn.functional.affine_grid(
+                torch.from_numpy(theta).to(device),
+                (count, 3, crop_h, crop_w),
+                align_corners=False
+            )
+            image_tensor = torch.from_numpy(image_rgb).to(device).permute(2, 0, 1).unsqueeze(0).float()
+            
+            crops = torch.nn.functional.grid_sample(
+                image_tensor.expand(count, -1, -1, -1), grid,
+                mode="bilinear", padding_mode="zeros", align_corners=False
+            )
+            crops = crops.round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+            grid = grid.cpu().numpy()
+        
+        # Keep only the pixels inside each crop's own mask (nearest source pixel)
+        source_x = np.floor((grid[..., 0] + 1) * width / 2).astype(np.int64)
+        source_y = np.floor((grid[..., 1] + 1) * height / 2).astype(np.int64)
+        inside = (source_x >= 0) & (source_x < width) & (source_y >= 0) & (source_y < height)
+        source_x = np.clip(source_x, 0, width - 1)
+        source_y = np.clip(source_y, 0, height - 1)
+        for slot, mask in enumerate(masks):
+            foreground = inside[slot] & mask[source_y[slot], source_x[slot]]
+            crops[slot][~foreground] = 0
+        
+        # Tile the crops into a sheet (row-major by slot)
+        columns = int(np.ceil(np.sqrt(count)))
+        rows = int(np.ceil(count / columns))
+        padded = np.zeros((rows * columns, crop_h, crop_w, 3), dtype=np.uint8)
+        padded[:count] = crops
+        sheet = padded.reshape(rows, columns, crop_h, crop_w, 3).transpose(0, 2, 1, 3, 4)
+        sheet = sheet.reshape(rows * crop_h, columns * crop_w, 3)
+        
+        os.makedirs(os.path.dirname(atlas_path) or ".", exist_ok=True)
+        np.save(atlas_path, crops)
+        sheet_path = self._atlas_sheet_path(atlas_path)
+        cv2.imwrite(sheet_path, cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR))
+        
+        index = []
+        for slot, chromosome_id in enumerate(chromosome_ids):
+            row, column = divmod(slot, columns)
+            index.append({
+                "id": chromosome_id,
+                "slot": slot,
+                "center": {"x": float(cx[slot]), "y": float(cy[slot])},
+                "angle": float(np.degrees(angle[slot])),
+                "scale": float(scale[slot]),
+                "length": float(length[slot]),
+                "width": float(thickness[slot]),
+                "sheet_rect": {
+                    "x": column * crop_w,
+                    "y": row * crop_h,
+                    "width": crop_w,
+                    "height": crop_h
+                }
+            })
+        
+        return {
+            "path": atlas_path,
+            "sheet_path": sheet_path,
+            "count": count,
+            "crop_size": {"width": crop_w, "height": crop_h},
+            "index": index
+        }
+    
+    def _atlas_sheet_path(self, atlas_path: str) -> str:
+        """
+        Get the path of the tiled sheet saved next to an atlas
+        """
+        return f"{os.path.splitext(atlas_path)[0]}_sheet.png"
+    
+    def delete_chromosome_atlas(self, atlas_path: str):
+        """
+        Delete an atlas and its tiled sheet, if present
+        """
+        for path in (atlas_path, self._atlas_sheet_path(atlas_path)):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def load_chromosome_atlas(self, atlas: Dict[str, Any]) -> Tuple[torch.Tensor, List[Dict]]:
+        """
+        Load a chromosome atlas as a (N, 3, H, W) float batch in [0, 1] plus its index
+        """
+        crops = np.load(atlas["path"])
+        batch = torch.from_numpy(crops).permute(0, 3, 1, 2).float().div_(255.0)
+        return batch, atlas["index"]
+    
     async def segment_with_prompts(
         self, 
         image_path: str, 
         points: List[Tuple[int, int]], 
-        labels: List[int]
+        labels: List[int],
+        profiler: Optional[RequestProfiler] = None
     ) -> Dict[str, Any]:
         """
         Segment with user-provided prompts (points)
@@ -348,34 +565,40 @@ class SAM2Service:
         if not self.is_initialized:
             raise RuntimeError("SAM2 service not initialized")
         
+        section = profiler.section if profiler else nullcontext
+        if profiler:
+            profiler.start()
+        
         try:
-            # Load image
-            image = cv2.imread(image_path)
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # Set image for predictor
-            self.predictor.set_image(image_rgb)
-            
-            # Convert points and labels to numpy arrays
-            points_array = np.array(points)
-            labels_array = np.array(labels)
+            with section():
+                # Load image
+                image = cv2.imread(image_path)
+                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                
+                # Set image for predictor
+                self.predictor.set_image(image_rgb)
+                
+                # Convert points and labels to numpy arrays
+                points_array = np.array(points)
+                labels_array = np.array(labels)
             
             # Run prediction in thread pool
             loop = asyncio.get_event_loop()
             masks, scores, _ = await loop.run_in_executor(
                 self.executor,
-                self.predictor.predict,
+                self._profiled(profiler, self.predictor.predict),
                 points_array,
                 labels_array
             )
             
             # Process results
             results = []
-            for i, (mask, score) in enumerate(zip(masks, scores)):
-                chromosome_data = self._extract_chromosome_features(mask, image_rgb, i)
-                if chromosome_data:
-                    chromosome_data["confidence"] = float(score)
-                    results.append(chromosome_data)
+            with section():
+                for i, (mask, score) in enumerate(zip(masks, scores)):
+                    chromosome_data = self._extract_chromosome_features(mask, image_rgb, i)
+                    if chromosome_data:
+                        chromosome_data["confidence"] = float(score)
+                        results.append(chromosome_data)
             
             return {
                 "chromosomes": results,
@@ -386,4 +609,8 @@ class SAM2Service:
             
         except Exception as e:
             logger.error(f"Prompt-based segmentation failed: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
+        
+        finally:
+            if profiler:
+                profiler.stop() 
\ No newline at end of file